@@ -2,80 +2,316 @@
 import os
 import time
 import json
+import copy
+import math
+import hashlib
+import functools
+import sqlite3
+import sys
+import importlib.util
 import logging
+import threading
+import orjson
+import fastjsonschema
 import requests
 import urllib.parse
-from flask import Flask, request, jsonify, make_response
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from cachetools import TTLCache
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FuturesTimeout, wait
+from flask import Flask, request, make_response
 from flask_cors import CORS
+from flask_compress import Compress
 from typing import List, Dict, Tuple, Optional
 
 logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s] %(message)s")
 
 app = Flask(__name__)
 CORS(app)
+# Compress JSON responses when the client's Accept-Encoding allows (Brotli preferred)
+app.config["COMPRESS_ALGORITHM"] = ["br", "gzip"]
+app.config["COMPRESS_MIMETYPES"] = ["application/json"]
+app.config["COMPRESS_MIN_SIZE"] = 512
+Compress(app)
 
 GOOGLE_MAPS_API_KEY = os.getenv("GOOGLE_MAPS_API_KEY")  # store securely in env var
-GOOGLE_DIRECTIONS_URL = "https://maps.googleapis.com/maps/api/directions/json"
+GOOGLE_ROUTES_URL = "https://routes.googleapis.com/directions/v2:computeRoutes"
+# Routes API v2 returns only the fields named here (legacy Directions returned steps/polylines too)
+GOOGLE_ROUTES_FIELD_MASK = "routes.distanceMeters,routes.duration,routes.optimizedIntermediateWaypointIndex"
+GOOGLE_ROUTE_MATRIX_URL = "https://routes.googleapis.com/distanceMatrix/v2:computeRouteMatrix"
+GOOGLE_ROUTE_MATRIX_FIELD_MASK = "originIndex,destinationIndex,distanceMeters,duration,condition"
+GOOGLE_GEOCODE_URL = "https://maps.googleapis.com/maps/api/geocode/json"
 
 # Constraints
 MIN_STOPS = 5
 MAX_STOPS = 10
-REQUEST_TIMEOUT = 15  # seconds for external calls
+REQUEST_TIMEOUT = 15  # seconds for external calls (read timeout per attempt)
+CONNECT_TIMEOUT = 3.05  # seconds per connection attempt
+
+# Module-level session: keep-alive connection pool + retries on transient Google errors.
+# Concurrent calls each reuse a warm pooled connection, so HTTP/2 multiplexing (httpx) would
+# only save the first handshakes while dropping the urllib3 Retry policy below.
+SESSION = requests.Session()
+SESSION.mount("https://", HTTPAdapter(
+    pool_connections=16,
+    pool_maxsize=32,
+    # computeRoutes/computeRouteMatrix are read-only POSTs, so they are safe to retry.
+    # Read timeouts are not retried (read=False re-raises them as requests Timeout -> 504) and
+    # Retry-After is ignored, so a call's time stays bounded.
+    max_retries=Retry(total=2, read=False, status=1, backoff_factor=0.2, status_forcelist=[429, 500, 502, 503, 504],
+                      allowed_methods=frozenset({"GET", "POST"}), respect_retry_after_header=False,
+                      raise_on_status=False),
+))
+# Worst case for one retried call: two attempts that get a response (the first reply + one status retry),
+# one failed connect, and backoff. Futures are awaited at most this long; on any error path the unfinished
+# ones are cancelled, which stops calls still queued. A call already running cannot be interrupted and
+# finishes in the background, so it holds its worker for at most this long after the caller gives up.
+GOOGLE_CALL_DEADLINE = 2 * (CONNECT_TIMEOUT + REQUEST_TIMEOUT) + CONNECT_TIMEOUT + 1
+
+# Connections per gevent worker (passed to gunicorn by __main__; keep wsgi.py's example in step)
+WORKER_CONNECTIONS = int(os.getenv("WORKER_CONNECTIONS", 1000))
+# True when loaded through wsgi.py, where pool "threads" are greenlets and cost almost nothing
+GEVENT_PATCHED = "gevent.monkey" in sys.modules and sys.modules["gevent.monkey"].is_module_patched("threading")
+
+# Shared pool so independent Google calls run concurrently (requests releases the GIL on I/O).
+# Under gevent every connection may have both /optimize calls in flight, so size the pool to match.
+EXECUTOR = ThreadPoolExecutor(max_workers=2 * WORKER_CONNECTIONS if GEVENT_PATCHED else 8)
+
+# In-process cache of successful Routes API responses (identical address lists are often resubmitted)
+DIRECTIONS_CACHE_TTL = 600  # seconds
+_DIRECTIONS_CACHE = TTLCache(maxsize=4096, ttl=DIRECTIONS_CACHE_TTL)
+_DIRECTIONS_CACHE_LOCK = threading.Lock()
+_DIRECTIONS_CACHE_STATS = {"hits": 0, "misses": 0}
+
+# Persistent raw address -> place_id cache, so differently formatted stops share Routes API work
+GEOCODE_CACHE_PATH = os.getenv("GEOCODE_CACHE_PATH", "geocode_cache.sqlite3")
+GEOCODE_CACHE_TTL = 30 * 24 * 3600  # seconds
+GEOCODE_NEGATIVE_TTL = 600  # seconds; failed lookups are remembered briefly so they aren't re-billed every request
+GEOCODE_TIMEOUT = 3  # seconds per Geocoding call
+GEOCODE_DEADLINE = 5  # seconds for resolving all stops before falling back to raw strings
+
+# Distance/duration matrices for local re-optimization (POST /matrix, /reoptimize). Stored in the same
+# SQLite file so every gunicorn worker sees them: one matrix per stop set (sorted locations), plus one
+# row per /matrix request mapping the submitted order onto that matrix.
+MATRIX_CACHE_TTL = 1800  # seconds
+
+# Cache database shared by all worker processes (file path kept under its original env var name).
+# sqlite3 calls are blocking C calls, so under gevent they stall the worker's hub while they run, and for
+# up to the busy timeout when another worker holds the write lock. WAL keeps reads off the writer's lock
+# and NORMAL sync drops the per-commit fsync, so that stall is just each small write.
+_CACHE_DB = sqlite3.connect(GEOCODE_CACHE_PATH, timeout=1, check_same_thread=False)
+_CACHE_DB_LOCK = threading.Lock()
+_CACHE_DB.execute("PRAGMA journal_mode=WAL")
+_CACHE_DB.execute("PRAGMA synchronous=NORMAL")
+with _CACHE_DB_LOCK, _CACHE_DB:
+    _CACHE_DB.execute("CREATE TABLE IF NOT EXISTS geocode "
+                      "(key TEXT PRIMARY KEY, place_id TEXT, lat REAL, lng REAL, ts REAL)")
+    _CACHE_DB.execute("DELETE FROM geocode WHERE ts < ? OR (place_id IS NULL AND ts < ?)",
+                      (time.time() - GEOCODE_CACHE_TTL, time.time() - GEOCODE_NEGATIVE_TTL))
+    _CACHE_DB.execute("CREATE TABLE IF NOT EXISTS stop_matrix "
+                      "(set_key TEXT PRIMARY KEY, distance_m BLOB, duration_s BLOB, mock INTEGER, ts REAL)")
+    _CACHE_DB.execute("CREATE TABLE IF NOT EXISTS matrix_request "
+                      "(key TEXT PRIMARY KEY, set_key TEXT, addresses BLOB, positions BLOB, ts REAL)")
 
 # ---- Utilities ----
+def address_key(addr: str) -> str:
+    """Case-insensitive identity of an address line (used for dedupe and the geocode cache)."""
+    return addr.strip().casefold()
+
+def ojsonify(obj, status: int = 200):
+    """jsonify() replacement that serializes with orjson."""
+    return app.response_class(orjson.dumps(obj), status=status, mimetype="application/json")
+
 def normalize_addresses(raw_text: str) -> List[str]:
-    """Trim lines, remove empties, dedupe preserving order."""
-    lines = [line.strip() for line in raw_text.splitlines()]
-    cleaned = []
-    seen = set()
-    for l in lines:
-        if not l:
+    """Trim lines, remove empties, dedupe (case-insensitively) preserving order."""
+    seen = {}
+    for line in raw_text.splitlines():
+        s = line.strip()
+        if not s:
             continue
-        if l.lower() in seen:
-            continue
-        seen.add(l.lower())
-        cleaned.append(l)
-    return cleaned
+        k = address_key(s)
+        if k not in seen:
+            seen[k] = s
+    return list(seen.values())
+
+def routes_waypoint(location: str) -> Dict:
+    """Routes API waypoint for an address or a 'place_id:<id>' location."""
+    if location.startswith("place_id:"):
+        return {"placeId": location[len("place_id:"):]}
+    return {"address": location}
 
 def build_directions_params(origin: str, destination: str, waypoints: List[str],
                             optimize: bool = False) -> Dict:
-    """Return params dict for Google Directions API."""
-    params = {
-        "origin": origin,
-        "destination": destination,
-        "key": GOOGLE_MAPS_API_KEY,
-        "mode": "driving",
-        "units": "metric"
+    """Return the computeRoutes request body for Google Routes API v2."""
+    return {
+        "origin": routes_waypoint(origin),
+        "destination": routes_waypoint(destination),
+        "intermediates": [routes_waypoint(w) for w in waypoints],
+        "travelMode": "DRIVE",
+        "optimizeWaypointOrder": optimize
     }
-    if waypoints:
-        wp = "|".join(waypoints)
-        if optimize:
-            params["waypoints"] = "optimize:true|" + wp
-        else:
-            params["waypoints"] = wp
-    return params
 
 def call_google_directions(params: Dict) -> Dict:
-    """Call Directions API and return parsed JSON. Raises on non-200 or status!=OK (but returns body)."""
-    r = requests.get(GOOGLE_DIRECTIONS_URL, params=params, timeout=REQUEST_TIMEOUT)
+    """
+    Call Routes API computeRoutes (field-masked to distance/duration/optimized order) and return
+    parsed JSON with a Directions-style "status" added: OK, or ZERO_RESULTS when no route was found.
+    Raises on non-200 (Routes API reports errors via HTTP status). OK responses are cached
+    for DIRECTIONS_CACHE_TTL seconds.
+    """
+    body = orjson.dumps(params, option=orjson.OPT_SORT_KEYS)
+    with _DIRECTIONS_CACHE_LOCK:
+        cached = _DIRECTIONS_CACHE.get(body)
+        if cached is not None:
+            _DIRECTIONS_CACHE_STATS["hits"] += 1
+            return copy.deepcopy(cached)
+        _DIRECTIONS_CACHE_STATS["misses"] += 1
+    headers = {
+        "Content-Type": "application/json",
+        "X-Goog-Api-Key": GOOGLE_MAPS_API_KEY,
+        "X-Goog-FieldMask": GOOGLE_ROUTES_FIELD_MASK
+    }
+    r = SESSION.post(GOOGLE_ROUTES_URL, data=body, headers=headers, timeout=(CONNECT_TIMEOUT, REQUEST_TIMEOUT))
+    r.raise_for_status()
+    res = orjson.loads(r.content)
+    res["status"] = "OK" if res.get("routes") else "ZERO_RESULTS"
+    if res["status"] == "OK":
+        with _DIRECTIONS_CACHE_LOCK:
+            _DIRECTIONS_CACHE[body] = copy.deepcopy(res)
+    return res
+
+def call_google_route_matrix(locations: List[str]) -> Tuple[List[List[Optional[int]]], List[List[Optional[int]]]]:
+    """
+    Call Routes API computeRouteMatrix once for all origin/destination pairs.
+    Returns (distance_m, duration_s) n x n matrices; pairs without a route are None. Raises on non-200.
+    """
+    n = len(locations)
+    stops = [{"waypoint": routes_waypoint(loc)} for loc in locations]
+    headers = {
+        "Content-Type": "application/json",
+        "X-Goog-Api-Key": GOOGLE_MAPS_API_KEY,
+        "X-Goog-FieldMask": GOOGLE_ROUTE_MATRIX_FIELD_MASK
+    }
+    body = {"origins": stops, "destinations": stops, "travelMode": "DRIVE"}
+    r = SESSION.post(GOOGLE_ROUTE_MATRIX_URL, data=orjson.dumps(body), headers=headers,
+                     timeout=(CONNECT_TIMEOUT, REQUEST_TIMEOUT))
     r.raise_for_status()
-    return r.json()
+    dist = [[None] * n for _ in range(n)]
+    dur = [[None] * n for _ in range(n)]
+    for el in orjson.loads(r.content):
+        # proto3 JSON omits zero values, so index 0 / 0 meters arrive as missing fields
+        i, j = el.get("originIndex", 0), el.get("destinationIndex", 0)
+        if i == j:
+            dist[i][j] = dur[i][j] = 0
+        elif el.get("condition") == "ROUTE_EXISTS":
+            dist[i][j] = int(el.get("distanceMeters", 0))
+            dur[i][j] = int(float(el.get("duration", "0s").rstrip("s")))
+    return dist, dur
+
+def geocode_cache_key(addr: str) -> str:
+    return hashlib.sha1(address_key(addr).encode("utf-8")).hexdigest()
+
+def _cached_geocode_entry(addr: str) -> Optional[Dict]:
+    """Unexpired cache row for an address; failed lookups are rows with place_id None."""
+    with _CACHE_DB_LOCK:
+        row = _CACHE_DB.execute("SELECT place_id, lat, lng, ts FROM geocode WHERE key = ?",
+                                (geocode_cache_key(addr),)).fetchone()
+    if row is None:
+        return None
+    ttl = GEOCODE_CACHE_TTL if row[0] is not None else GEOCODE_NEGATIVE_TTL
+    if time.time() - row[3] >= ttl:
+        return None
+    return {"place_id": row[0], "lat": row[1], "lng": row[2], "ts": row[3]}
+
+def _store_geocode_entry(addr: str, entry: Dict) -> None:
+    with _CACHE_DB_LOCK, _CACHE_DB:
+        _CACHE_DB.execute("INSERT OR REPLACE INTO geocode (key, place_id, lat, lng, ts) VALUES (?, ?, ?, ?, ?)",
+                          (geocode_cache_key(addr), entry["place_id"], entry["lat"], entry["lng"], entry["ts"]))
+
+def cached_geocode(addr: str) -> Optional[Dict]:
+    """Return the unexpired cached geocode for an address without touching the network."""
+    entry = _cached_geocode_entry(addr)
+    return entry if entry is not None and entry["place_id"] is not None else None
+
+def geocode_or_cached(addr: str) -> Optional[Dict]:
+    """
+    Resolve an address to {"place_id", "lat", "lng", "ts"} using the persistent cache,
+    calling the Geocoding API only for unseen (or expired) addresses. Returns None if unresolved.
+    Only definite "no result" answers are cached as misses (for GEOCODE_NEGATIVE_TTL seconds);
+    transport errors and error statuses are retried on the next request.
+    """
+    cached = _cached_geocode_entry(addr)
+    if cached is not None:
+        return cached if cached["place_id"] is not None else None
+
+    now = time.time()
+    miss = {"place_id": None, "lat": None, "lng": None, "ts": now}
+    try:
+        r = SESSION.get(GOOGLE_GEOCODE_URL, params={"address": addr, "key": GOOGLE_MAPS_API_KEY},
+                        timeout=(CONNECT_TIMEOUT, GEOCODE_TIMEOUT))
+        r.raise_for_status()
+        res = orjson.loads(r.content)
+    except (requests.exceptions.RequestException, orjson.JSONDecodeError) as e:
+        logging.warning("Geocoding failed for %r: %s", addr, e)
+        return None
+    status = res.get("status")
+    if status == "ZERO_RESULTS" or (status == "OK" and not res.get("results")):
+        logging.warning("Geocoding found no result for %r", addr)
+        _store_geocode_entry(addr, miss)
+        return None
+    if status != "OK":
+        logging.warning("Geocoding returned %s for %r", status, addr)
+        return None
+
+    top = res["results"][0]
+    loc = top.get("geometry", {}).get("location", {})
+    entry = {"place_id": top["place_id"], "lat": loc.get("lat"), "lng": loc.get("lng"), "ts": now}
+    _store_geocode_entry(addr, entry)
+    return entry
+
+def directions_location(addr: str) -> str:
+    """Return the Routes API form of an address: 'place_id:<id>' when resolvable, else the raw string."""
+    geo = geocode_or_cached(addr)
+    return f"place_id:{geo['place_id']}" if geo else addr
+
+def resolve_locations(addresses: List[str]) -> List[str]:
+    """
+    directions_location() for every stop within GEOCODE_DEADLINE seconds; stops not resolved
+    in time fall back to their raw address string.
+    Cache hits are answered inline. Misses get a pool of their own (one thread per miss), so lookups
+    never wait behind other requests' work or hold EXECUTOR workers past the deadline.
+    """
+    locations = []
+    misses = []
+    for i, addr in enumerate(addresses):
+        cached = _cached_geocode_entry(addr)
+        if cached is None:
+            misses.append(i)
+            locations.append(addr)
+        else:
+            locations.append(f"place_id:{cached['place_id']}" if cached["place_id"] is not None else addr)
+    if not misses:
+        return locations
+
+    pool = ThreadPoolExecutor(max_workers=len(misses))
+    futures = {i: pool.submit(directions_location, addresses[i]) for i in misses}
+    try:
+        done, _ = wait(futures.values(), timeout=GEOCODE_DEADLINE)
+        for i, f in futures.items():
+            if f in done and f.exception() is None:
+                locations[i] = f.result()
+    finally:
+        # Lookups still running finish in the background (bounded by GEOCODE_TIMEOUT) and cache their result
+        pool.shutdown(wait=False, cancel_futures=True)
+    return locations
 
 def sum_route_distance_and_time(route: Dict) -> Tuple[int, int]:
     """
-    Given a route (one element of 'routes' array), sum legs distance and duration.
+    Given a route (one element of 'routes' array), read its total distance and duration.
+    Routes API reports duration as a string like "1234s".
     Returns (distance_meters, duration_seconds)
     """
-    legs = route.get("legs", [])
-    total_m = 0
-    total_s = 0
-    for leg in legs:
-        d = leg.get("distance", {}).get("value")
-        t = leg.get("duration", {}).get("value")
-        if isinstance(d, (int, float)):
-            total_m += int(d)
-        if isinstance(t, (int, float)):
-            total_s += int(t)
+    total_m = int(route.get("distanceMeters") or 0)
+    total_s = int(float((route.get("duration") or "0s").rstrip("s")))
     return total_m, total_s
 
 def meters_to_km_str(m: int) -> str:
@@ -91,51 +327,207 @@ def seconds_to_human(s: int) -> str:
         return f"{h}h {m}m"
     return f"{m}m"
 
+@functools.lru_cache(maxsize=4096)
+def _quote_address(addr: str) -> str:
+    """Percent-encode one address for a URL query (memoized; the same stops recur across requests)."""
+    return urllib.parse.quote(addr, safe=",:")
+
 def make_google_maps_driver_link(origin: str, dest: str, waypoints_ordered: List[str]) -> str:
     """
     Compose a single Google Maps directions URL that opens the route with ordered waypoints.
     We'll use the universal "https://www.google.com/maps/dir/?api=1" URL.
     """
     base = "https://www.google.com/maps/dir/?api=1"
-    params = {
-        "origin": origin,
-        "destination": dest,
-        # waypoints as pipe-separated
-    }
+    url = f"{base}&origin={_quote_address(origin)}&destination={_quote_address(dest)}"
     if waypoints_ordered:
-        params["waypoints"] = "|".join(waypoints_ordered)
-    q = "&".join(f"{k}={urllib.parse.quote(v)}" for k, v in params.items())
-    return f"{base}&{q}"
+        # waypoints as pipe-separated
+        url += "&waypoints=" + "|".join(_quote_address(w) for w in waypoints_ordered)
+    return url
+
+# ---- Local TSP helpers ----
+EARTH_RADIUS_M = 6371000.0
+MOCK_SPEED_MPS = 30 / 3.6  # assumed urban driving speed for offline duration estimates
+
+def haversine_m(a: Tuple[float, float], b: Tuple[float, float]) -> float:
+    """Great-circle distance in meters between two (lat, lng) points."""
+    lat1, lng1 = math.radians(a[0]), math.radians(a[1])
+    lat2, lng2 = math.radians(b[0]), math.radians(b[1])
+    h = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((lng2 - lng1) / 2) ** 2
+    return 2 * EARTH_RADIUS_M * math.asin(math.sqrt(h))
+
+def haversine_matrix(coords: List[Tuple[float, float]]) -> List[List[float]]:
+    n = len(coords)
+    dist = [[0.0] * n for _ in range(n)]
+    for i in range(n):
+        for j in range(i + 1, n):
+            dist[i][j] = dist[j][i] = haversine_m(coords[i], coords[j])
+    return dist
+
+def path_length(dist: List[List[float]], order: List[int]) -> float:
+    return sum(dist[a][b] for a, b in zip(order, order[1:]))
+
+def held_karp(dist: List[List[float]]) -> List[int]:
+    """
+    Exact shortest path from node 0 to node n-1 visiting every node once (Held-Karp DP).
+    O(2^m * m^2) for m = n-2 intermediate stops, i.e. ~16k steps at MAX_STOPS.
+    Returns the node order as a list of indices.
+    """
+    n = len(dist)
+    if n <= 2:
+        return list(range(n))
+    m = n - 2  # intermediate nodes 1..n-2 map to bits 0..m-1
+    full = (1 << m) - 1
+    inf = float("inf")
+    cost = [[inf] * m for _ in range(1 << m)]
+    parent = [[-1] * m for _ in range(1 << m)]
+    for j in range(m):
+        cost[1 << j][j] = dist[0][j + 1]
+    for mask in range(1, full + 1):
+        row = cost[mask]
+        for j in range(m):
+            c = row[j]
+            if c == inf:
+                continue
+            for k in range(m):
+                if mask & (1 << k):
+                    continue
+                nxt = mask | (1 << k)
+                nc = c + dist[j + 1][k + 1]
+                if nc < cost[nxt][k]:
+                    cost[nxt][k] = nc
+                    parent[nxt][k] = j
+    last = min(range(m), key=lambda j: cost[full][j] + dist[j + 1][n - 1])
+    order = []
+    mask = full
+    while last != -1:
+        order.append(last + 1)
+        last, mask = parent[mask][last], mask & ~(1 << last)
+    return [0] + order[::-1] + [n - 1]
 
 # ---- Mock helpers ----
+_MOCK_LEG_M = 3000
+_MOCK_LEG_S = 10 * 60
+_MOCK_DIST_SAVE_PCT = 15  # pretend 15% distance savings
+_MOCK_DUR_SAVE_PCT = 12   # pretend 12% duration savings
+
+def local_tsp_optimization(addresses: List[str]) -> Optional[Dict]:
+    """
+    Optimize offline with Held-Karp over straight-line distances between cached geocodes.
+    Returns None unless every address has a cached location.
+    """
+    geos = [cached_geocode(a) for a in addresses]
+    if any(g is None or g["lat"] is None or g["lng"] is None for g in geos):
+        return None
+    dist = haversine_matrix([(g["lat"], g["lng"]) for g in geos])
+    best = held_karp(dist)
+    optimized = [addresses[i] for i in best]
+    orig_m = int(path_length(dist, list(range(len(addresses)))))
+    opt_m = int(path_length(dist, best))
+    return {
+        "ok": True,
+        "optimized_order": optimized,
+        "original_order": addresses,
+        "original_distance_m": orig_m,
+        "optimized_distance_m": opt_m,
+        "original_duration_s": int(orig_m / MOCK_SPEED_MPS),
+        "optimized_duration_s": int(opt_m / MOCK_SPEED_MPS),
+        "driver_link": make_google_maps_driver_link(optimized[0], optimized[-1], optimized[1:-1]),
+        "note": "mock mode (straight-line distances between cached geocodes)"
+    }
+
 def deterministic_mock_optimization(addresses: List[str]) -> Dict:
     """
     Create deterministic mock results to use when API key is missing.
-    Reorders by simple heuristic (reverse) and gives fake distances.
+    Uses the local Held-Karp optimizer when all stops have cached geocodes,
+    otherwise reorders by simple heuristic (reverse) and gives fake distances.
     """
+    local = local_tsp_optimization(addresses)
+    if local is not None:
+        return local
     # ensure deterministic: reverse order except keep origin same
-    origin = addresses[0]
-    dest = addresses[-1]
-    middle = addresses[1:-1]
-    optimized_middle = list(reversed(middle))
-    optimized = [origin] + optimized_middle + [dest] if len(addresses) >= 2 else addresses[:]
-    # compute fake distances: sum of 3km per leg
-    legs = max(1, len(optimized)-1)
-    distance_m = legs * 3000
-    duration_s = legs * 10 * 60
+    # (the handler guarantees MIN_STOPS..MAX_STOPS addresses, so origin != dest)
+    origin, *middle, dest = addresses
+    optimized = [origin, *reversed(middle), dest]
+    # compute fake distances: sum of 3km / 10min per leg
+    legs = len(addresses) - 1
+    distance_m = legs * _MOCK_LEG_M
+    duration_s = legs * _MOCK_LEG_S
     return {
         "ok": True,
         "optimized_order": optimized,
         "original_order": addresses,
         "original_distance_m": distance_m,
-        "optimized_distance_m": distance_m - int(0.15 * distance_m),  # pretend 15% savings
+        "optimized_distance_m": distance_m - distance_m * _MOCK_DIST_SAVE_PCT // 100,
         "original_duration_s": duration_s,
-        "optimized_duration_s": duration_s - int(0.12 * duration_s),
-        "driver_link": make_google_maps_driver_link(origin, dest, optimized[1:-1]),
+        "optimized_duration_s": duration_s - duration_s * _MOCK_DUR_SAVE_PCT // 100,
+        "driver_link": make_google_maps_driver_link(origin, dest, middle[::-1]),
         "note": "mock mode (no Google API key)"
     }
 
+def build_route_result(original_order: List[str], optimized_order: List[str],
+                       orig_dist_m: int, orig_dur_s: int, opt_dist_m: int, opt_dur_s: int,
+                       waypoint_order: List[int]) -> Dict:
+    """Response body comparing the original and optimized orders (shared by /optimize and /reoptimize)."""
+    return {
+        "ok": True,
+        "mock": False,
+        "original": {
+            "order": original_order,
+            "distance_m": orig_dist_m,
+            "duration_s": orig_dur_s
+        },
+        "optimized": {
+            "order": optimized_order,
+            "distance_m": opt_dist_m,
+            "duration_s": opt_dur_s,
+            "waypoint_order_indices": waypoint_order
+        },
+        "savings": {
+            "distance_m_saved": max(0, orig_dist_m - opt_dist_m),
+            "distance_pct_saved": round(100 * (orig_dist_m - opt_dist_m) / max(1, orig_dist_m), 2),
+            "duration_s_saved": max(0, orig_dur_s - opt_dur_s)
+        },
+        # Create driver-ready Google Maps link with optimized waypoint order (exclude origin/destination)
+        "driver_link": make_google_maps_driver_link(optimized_order[0], optimized_order[-1], optimized_order[1:-1])
+    }
+
+def google_error_response(e: Exception, endpoint: str, api: str = "Routes API"):
+    """Map an exception raised while calling Google (`api` names the service in messages) to a JSON error response."""
+    if isinstance(e, (requests.exceptions.Timeout, FuturesTimeout)):
+        return ojsonify({"ok": False, "error": f"Request to Google {api} timed out. Try again."}, 504)
+    if isinstance(e, requests.exceptions.HTTPError):
+        status_code = getattr(e.response, "status_code", 502)
+        try:
+            body = orjson.loads(e.response.content)
+        except Exception:
+            body = e.response.text if e.response is not None else str(e)
+        return ojsonify({"ok": False, "error": f"Google {api} HTTP error", "details": body}, status_code)
+    logging.exception("Unexpected error in %s", endpoint)
+    return ojsonify({"ok": False, "error": "Unexpected server error", "details": str(e)}, 500)
+
+def read_payload(validate) -> Tuple[Optional[Dict], Optional[object]]:
+    """Parse and validate the JSON body; returns (payload, None) or (None, error response)."""
+    try:
+        payload = orjson.loads(request.get_data())
+        validate(payload)
+    except orjson.JSONDecodeError:
+        return None, ojsonify({"ok": False, "error": "Request body must be valid JSON."}, 400)
+    except fastjsonschema.JsonSchemaException as e:
+        return None, ojsonify({"ok": False, "error": f"Invalid request: {e.message}"}, 400)
+    return payload, None
+
 # ---- Main endpoint ----
+# Compiled once at import; see the optimize_route docstring for the shape.
+validate_optimize_payload = fastjsonschema.compile({
+    "type": "object",
+    "properties": {
+        "addresses_text": {"type": "string"},
+        "roundtrip": {"type": "boolean"},
+        "mock": {"type": "boolean"}
+    },
+    "required": ["addresses_text"]
+})
+
 @app.route("/optimize", methods=["POST", "OPTIONS"])
 def optimize_route():
     """
@@ -148,25 +540,27 @@ def optimize_route():
     """
     if request.method == "OPTIONS":
         return make_response("", 200)
-    payload = request.get_json(force=True, silent=True) or {}
-    addresses_text = payload.get("addresses_text", "")
-    roundtrip = bool(payload.get("roundtrip", False))
-    force_mock = bool(payload.get("mock", False))
+    payload, error = read_payload(validate_optimize_payload)
+    if error is not None:
+        return error
+    addresses_text = payload["addresses_text"]
+    roundtrip = payload.get("roundtrip", False)
+    force_mock = payload.get("mock", False)
 
     # normalize and validate
     addresses = normalize_addresses(addresses_text)
     if not addresses:
-        return jsonify({"ok": False, "error": "No addresses provided. Paste 5–10 addresses, one per line."}), 400
+        return ojsonify({"ok": False, "error": "No addresses provided. Paste 5–10 addresses, one per line."}, 400)
 
     # Limit to configured bounds
     if len(addresses) < MIN_STOPS or len(addresses) > MAX_STOPS:
-        return jsonify({"ok": False, "error": f"Provide between {MIN_STOPS} and {MAX_STOPS} unique addresses (you gave {len(addresses)})."}), 400
+        return ojsonify({"ok": False, "error": f"Provide between {MIN_STOPS} and {MAX_STOPS} unique addresses (you gave {len(addresses)})."}, 400)
 
     # Mock mode if no API key or explicitly requested
     if force_mock or not GOOGLE_MAPS_API_KEY:
         logging.info("Running in mock mode (no Google API key or forced).")
         data = deterministic_mock_optimization(addresses)
-        return jsonify({"ok": True, "mock": True, **data})
+        return ojsonify({"ok": True, "mock": True, **data})
 
     try:
         # Decide origin/destination/waypoints. Use first as origin, last as destination.
@@ -174,98 +568,239 @@ def optimize_route():
         destination = addresses[-1]
         waypoints = addresses[1:-1]  # may be empty if only 2 addresses (but we require >=5)
 
-        # 1) Call Directions WITHOUT optimization to measure "original" distance/time.
-        params_original = build_directions_params(origin, destination, waypoints, optimize=False)
-        logging.info("Calling Google Directions (non-optimized)...")
-        res_orig = call_google_directions(params_original)
+        # Call Routes API WITHOUT and WITH optimization concurrently; the non-optimized
+        # call measures the "original" distance/time. The optimized response only describes
+        # the optimized order, so user-order totals can't be re-derived from it,
+        # and a Distance Matrix batch would bill (n-1)^2 elements to replace this one call.
+        # Routes API is fed canonical place_ids; user strings are kept for the response and driver link.
+        locations = resolve_locations(addresses)
+        loc_origin, loc_destination, loc_waypoints = locations[0], locations[-1], locations[1:-1]
+        params_original = build_directions_params(loc_origin, loc_destination, loc_waypoints, optimize=False)
+        params_opt = build_directions_params(loc_origin, loc_destination, loc_waypoints, optimize=True)
+        logging.info("Calling Google Routes API (non-optimized + optimized)...")
+        fut_orig = EXECUTOR.submit(call_google_directions, params_original)
+        fut_opt = EXECUTOR.submit(call_google_directions, params_opt)
+        try:
+            res_orig = fut_orig.result(timeout=GOOGLE_CALL_DEADLINE)
+            res_opt = fut_opt.result(timeout=GOOGLE_CALL_DEADLINE)
+        finally:
+            # no-op for finished calls; keeps queued ones from billing Google after we've answered
+            fut_orig.cancel()
+            fut_opt.cancel()
+
+        # Quota/key errors arrive as HTTP errors (handled below); here only "no route found" remains.
         if res_orig.get("status") != "OK":
-            # handle permissive statuses
-            err_msg = f"Directions API (non-optimized) error: {res_orig.get('status')}"
-            # Surface helpful GOOGLE API error messages (over query limit etc)
-            if "error_message" in res_orig:
-                err_msg += f": {res_orig.get('error_message')}"
-            return jsonify({"ok": False, "error": err_msg, "details": res_orig}), 502
+            err_msg = f"Routes API (non-optimized) error: {res_orig.get('status')}"
+            return ojsonify({"ok": False, "error": err_msg, "details": res_orig}, 502)
 
         route_orig = res_orig["routes"][0]
         orig_dist_m, orig_dur_s = sum_route_distance_and_time(route_orig)
 
-        # 2) Call Directions WITH optimizeWaypoints=true
-        params_opt = build_directions_params(origin, destination, waypoints, optimize=True)
-        logging.info("Calling Google Directions (optimized)...")
-        res_opt = call_google_directions(params_opt)
         if res_opt.get("status") != "OK":
-            err_msg = f"Directions API (optimized) error: {res_opt.get('status')}"
-            if "error_message" in res_opt:
-                err_msg += f": {res_opt.get('error_message')}"
-            return jsonify({"ok": False, "error": err_msg, "details": res_opt}), 502
+            err_msg = f"Routes API (optimized) error: {res_opt.get('status')}"
+            return ojsonify({"ok": False, "error": err_msg, "details": res_opt}, 502)
 
         route_opt = res_opt["routes"][0]
         opt_dist_m, opt_dur_s = sum_route_distance_and_time(route_opt)
 
-        # Google returns waypoint_order: mapping of indices of supplied waypoints to optimized order
+        # Google returns optimizedIntermediateWaypointIndex: mapping of indices of supplied waypoints to optimized order
         # waypoint_order is a list of integers referring to position in waypoints list.
-        waypoint_order = res_opt["routes"][0].get("waypoint_order", [])
+        waypoint_order = route_opt.get("optimizedIntermediateWaypointIndex", [])
 
         # Construct resolved addresses: Google may give leg end addresses; prefer geocoded_waypoint->place_id info if available.
         # We'll map optimized order back to full address strings.
         original_order = [origin] + waypoints + [destination]
 
-        # Build optimized order list of addresses
-        optimized_order = [origin]
-        for idx in waypoint_order:
-            # idx refers to the index inside waypoints list (0..len(waypoints)-1)
-            if 0 <= idx < len(waypoints):
-                optimized_order.append(waypoints[idx])
-        optimized_order.append(destination)
+        # Build optimized order list of addresses by positional assignment into a preallocated list
+        optimized_order = [None] * len(original_order)
+        optimized_order[0] = origin
+        optimized_order[-1] = destination
+        if len(waypoint_order) == len(waypoints):
+            for pos, idx in enumerate(waypoint_order, start=1):
+                # idx refers to the index inside waypoints list (0..len(waypoints)-1)
+                if 0 <= idx < len(waypoints):
+                    optimized_order[pos] = waypoints[idx]
 
-        # If waypoint_order length doesn't match, fall back to original
-        if len(optimized_order) != len(original_order):
+        # If waypoint_order doesn't cover every waypoint, fall back to original
+        if None in optimized_order:
             optimized_order = original_order[:]
 
-        # Create driver-ready Google Maps link with optimized waypoint order (exclude origin/destination)
-        driver_link = make_google_maps_driver_link(origin, destination, optimized_order[1:-1])
-
-        result = {
-            "ok": True,
-            "mock": False,
-            "original": {
-                "order": original_order,
-                "distance_m": orig_dist_m,
-                "duration_s": orig_dur_s
-            },
-            "optimized": {
-                "order": optimized_order,
-                "distance_m": opt_dist_m,
-                "duration_s": opt_dur_s,
-                "waypoint_order_indices": waypoint_order
-            },
-            "savings": {
-                "distance_m_saved": max(0, orig_dist_m - opt_dist_m),
-                "distance_pct_saved": round(100 * (orig_dist_m - opt_dist_m) / max(1, orig_dist_m), 2),
-                "duration_s_saved": max(0, orig_dur_s - opt_dur_s)
-            },
-            "driver_link": driver_link
-        }
-        return jsonify(result)
-    except requests.exceptions.Timeout:
-        return jsonify({"ok": False, "error": "Request to Google Directions timed out. Try again."}), 504
-    except requests.exceptions.HTTPError as e:
-        status_code = getattr(e.response, "status_code", 502)
-        try:
-            body = e.response.json()
-        except Exception:
-            body = e.response.text if e.response is not None else str(e)
-        return jsonify({"ok": False, "error": "Google Directions HTTP error", "details": body}), status_code
+        result = build_route_result(original_order, optimized_order, orig_dist_m, orig_dur_s,
+                                    opt_dist_m, opt_dur_s, waypoint_order)
+        return ojsonify(result)
     except Exception as e:
-        logging.exception("Unexpected error in /optimize")
-        return jsonify({"ok": False, "error": "Unexpected server error", "details": str(e)}), 500
+        return google_error_response(e, "/optimize")
+
+# ---- Matrix + local re-optimization endpoints ----
+validate_matrix_payload = fastjsonschema.compile({
+    "type": "object",
+    "properties": {"addresses_text": {"type": "string"}},
+    "required": ["addresses_text"]
+})
+
+validate_reoptimize_payload = fastjsonschema.compile({
+    "type": "object",
+    "properties": {
+        "matrix_key": {"type": "string"},
+        "order": {"type": "array", "items": {"type": "string"}}
+    },
+    "required": ["matrix_key"]
+})
+
+def load_stop_matrix(set_key: str) -> Optional[Dict]:
+    """Unexpired matrix for a stop set (rows/columns in sorted-location order), or None."""
+    with _CACHE_DB_LOCK:
+        row = _CACHE_DB.execute("SELECT distance_m, duration_s, mock, ts FROM stop_matrix WHERE set_key = ?",
+                                (set_key,)).fetchone()
+    if row is None or time.time() - row[3] >= MATRIX_CACHE_TTL:
+        return None
+    return {"distance_m": orjson.loads(row[0]), "duration_s": orjson.loads(row[1]), "mock": bool(row[2])}
+
+def touch_stop_matrix(set_key: str) -> bool:
+    """Restart an unexpired matrix's TTL so it outlives the /matrix request about to point at it."""
+    now = time.time()
+    with _CACHE_DB_LOCK, _CACHE_DB:
+        cur = _CACHE_DB.execute("UPDATE stop_matrix SET ts = ? WHERE set_key = ? AND ts > ?",
+                                (now, set_key, now - MATRIX_CACHE_TTL))
+    return cur.rowcount == 1
+
+def store_stop_matrix(set_key: str, dist: List[List[float]], dur: List[List[float]], mock: bool) -> None:
+    now = time.time()
+    with _CACHE_DB_LOCK, _CACHE_DB:
+        _CACHE_DB.execute("DELETE FROM stop_matrix WHERE ts < ?", (now - MATRIX_CACHE_TTL,))
+        _CACHE_DB.execute("INSERT OR REPLACE INTO stop_matrix (set_key, distance_m, duration_s, mock, ts) "
+                          "VALUES (?, ?, ?, ?, ?)", (set_key, orjson.dumps(dist), orjson.dumps(dur), int(mock), now))
+
+def load_matrix_request(key: str) -> Optional[Dict]:
+    """Unexpired /matrix request: submitted addresses and each one's row in the stop-set matrix."""
+    with _CACHE_DB_LOCK:
+        row = _CACHE_DB.execute("SELECT set_key, addresses, positions, ts FROM matrix_request WHERE key = ?",
+                                (key,)).fetchone()
+    if row is None or time.time() - row[3] >= MATRIX_CACHE_TTL:
+        return None
+    return {"set_key": row[0], "addresses": orjson.loads(row[1]), "positions": orjson.loads(row[2])}
+
+def store_matrix_request(key: str, set_key: str, addresses: List[str], positions: List[int]) -> None:
+    now = time.time()
+    with _CACHE_DB_LOCK, _CACHE_DB:
+        _CACHE_DB.execute("DELETE FROM matrix_request WHERE ts < ?", (now - MATRIX_CACHE_TTL,))
+        _CACHE_DB.execute("INSERT OR REPLACE INTO matrix_request (key, set_key, addresses, positions, ts) "
+                          "VALUES (?, ?, ?, ?, ?)",
+                          (key, set_key, orjson.dumps(addresses), orjson.dumps(positions), now))
+
+@app.route("/matrix", methods=["POST", "OPTIONS"])
+def build_matrix():
+    """
+    Expected JSON: {"addresses_text": "addr1\naddr2\n..."}   // 5-10 lines
+    Fetches one n x n distance/duration matrix (one computeRouteMatrix call) and caches it per set of
+    stops, so any ordering of the same stops shares it. Returns a matrix_key for /reoptimize and the
+    addresses in the order submitted.
+    Without an API key the matrix is built from straight-line distances between cached geocodes.
+    """
+    if request.method == "OPTIONS":
+        return make_response("", 200)
+    payload, error = read_payload(validate_matrix_payload)
+    if error is not None:
+        return error
+    addresses = normalize_addresses(payload["addresses_text"])
+    if len(addresses) < MIN_STOPS or len(addresses) > MAX_STOPS:
+        return ojsonify({"ok": False, "error": f"Provide between {MIN_STOPS} and {MAX_STOPS} unique addresses (you gave {len(addresses)})."}, 400)
+
+    mock = not GOOGLE_MAPS_API_KEY
+    try:
+        locations = addresses if mock else resolve_locations(addresses)
+        # The matrix is keyed on the sorted stop set; positions[i] is submitted stop i's row in it
+        sorted_idx = sorted(range(len(locations)), key=lambda i: locations[i])
+        positions = [0] * len(locations)
+        for row, i in enumerate(sorted_idx):
+            positions[i] = row
+        set_id = "\n".join(["mock" if mock else "routes"] + [locations[i] for i in sorted_idx])
+        set_key = hashlib.sha1(set_id.encode("utf-8")).hexdigest()
+        key = hashlib.sha1("\n".join([set_key] + addresses).encode("utf-8")).hexdigest()
+
+        cached = touch_stop_matrix(set_key)
+        if not cached:
+            if mock:
+                geos = [cached_geocode(addresses[i]) for i in sorted_idx]
+                if any(g is None or g["lat"] is None or g["lng"] is None for g in geos):
+                    return ojsonify({"ok": False, "error": "Mock mode needs a cached geocode for every stop."}, 400)
+                dist = haversine_matrix([(g["lat"], g["lng"]) for g in geos])
+                dur = [[d / MOCK_SPEED_MPS for d in row] for row in dist]
+            else:
+                logging.info("Calling Google Route Matrix for %d stops...", len(locations))
+                dist, dur = call_google_route_matrix([locations[i] for i in sorted_idx])
+                if any(v is None for row in dist for v in row):
+                    return ojsonify({"ok": False, "error": "Route Matrix API error: some stops are not reachable from each other."}, 502)
+            store_stop_matrix(set_key, dist, dur, mock)
+        store_matrix_request(key, set_key, addresses, positions)
+        return ojsonify({"ok": True, "matrix_key": key, "addresses": addresses, "cached": cached})
+    except Exception as e:
+        return google_error_response(e, "/matrix", api="Route Matrix API")
+
+@app.route("/reoptimize", methods=["POST", "OPTIONS"])
+def reoptimize_route():
+    """
+    Expected JSON:
+    {
+      "matrix_key": "<key from /matrix>",
+      "order": ["addr1", "addr2", ...]   // optional: current order (first/last stay fixed); defaults to the
+                                         // order submitted to /matrix
+    }
+    Runs the exact local optimizer over the cached matrix; no Google calls.
+    """
+    if request.method == "OPTIONS":
+        return make_response("", 200)
+    payload, error = read_payload(validate_reoptimize_payload)
+    if error is not None:
+        return error
+    req = load_matrix_request(payload["matrix_key"])
+    matrix = load_stop_matrix(req["set_key"]) if req is not None else None
+    if matrix is None:
+        return ojsonify({"ok": False, "error": "Unknown or expired matrix_key. Call /matrix again."}, 404)
+
+    addresses = req["addresses"]
+    index = {address_key(addr): i for i, addr in enumerate(addresses)}
+    order = payload.get("order") or addresses
+    idx = [index.get(address_key(addr)) for addr in order]
+    if None in idx or sorted(idx) != list(range(len(index))):
+        return ojsonify({"ok": False, "error": "order must list each matrix address exactly once."}, 400)
+
+    rows = [req["positions"][i] for i in idx]
+    dist = [[matrix["distance_m"][a][b] for b in rows] for a in rows]
+    dur = [[matrix["duration_s"][a][b] for b in rows] for a in rows]
+    identity = list(range(len(idx)))
+    best = held_karp(dist)
+    original_order = [addresses[i] for i in idx]
+    optimized_order = [original_order[i] for i in best]
+    result = build_route_result(original_order, optimized_order,
+                                int(path_length(dist, identity)), int(path_length(dur, identity)),
+                                int(path_length(dist, best)), int(path_length(dur, best)),
+                                [i - 1 for i in best[1:-1]])
+    result["mock"] = matrix["mock"]
+    return ojsonify(result)
 
 # Simple health route
 @app.route("/", methods=["GET"])
 def home():
-    return jsonify({"ok": True, "service": "LogiSwift Route Optimizer", "mock_mode": not bool(GOOGLE_MAPS_API_KEY)})
+    return ojsonify({"ok": True, "service": "LogiSwift Route Optimizer", "mock_mode": not bool(GOOGLE_MAPS_API_KEY)})
+
+# Routes API response cache counters
+@app.route("/cache/stats", methods=["GET"])
+def cache_stats():
+    with _DIRECTIONS_CACHE_LOCK:
+        stats = dict(_DIRECTIONS_CACHE_STATS, size=len(_DIRECTIONS_CACHE), maxsize=_DIRECTIONS_CACHE.maxsize,
+                     ttl_s=DIRECTIONS_CACHE_TTL)
+    return ojsonify({"ok": True, "directions_cache": stats})
 
 if __name__ == "__main__":
     port = int(os.getenv("PORT", 5000))
     logging.info("Starting LogiSwift server on 0.0.0.0:%d (mock_mode=%s)", port, not bool(GOOGLE_MAPS_API_KEY))
-    app.run(host="0.0.0.0", port=port, debug=False)
\ No newline at end of file
+    # Prefer gunicorn + gevent workers (see wsgi.py) when both are installed in this interpreter;
+    # otherwise fall back to the threaded dev server.
+    if importlib.util.find_spec("gunicorn") and importlib.util.find_spec("gevent"):
+        logging.info("Handing off to gunicorn with gevent workers (see wsgi.py).")
+        os.execv(sys.executable, [sys.executable, "-m", "gunicorn", "-k", "gevent", "-w", str(os.cpu_count() or 1),
+                                  "--worker-connections", str(WORKER_CONNECTIONS), "-b", f"0.0.0.0:{port}",
+                                  "--chdir", os.path.dirname(os.path.abspath(__file__)), "wsgi:application"])
+    logging.info("gunicorn/gevent not installed; using the threaded Flask dev server.")
+    app.run(host="0.0.0.0", port=port, debug=False, threaded=True)
\ No newline at end of file
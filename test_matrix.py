@@ -0,0 +1,109 @@
+# test_matrix.py
+import os
+
+import pytest
+
+os.environ.setdefault("GEOCODE_CACHE_PATH", ":memory:")
+
+import new
+
+# Stops on a straight road, km from the start; the best route visits them in this order
+POSITION_KM = {"A St": 0, "B St": 1, "C St": 2, "D St": 3, "E St": 4}
+SUBMITTED = ["A St", "C St", "B St", "D St", "E St"]
+
+
+@pytest.fixture
+def matrix_calls(monkeypatch):
+    """Stub the Route Matrix API with straight-road distances; returns the list of requested stop lists."""
+    calls = []
+
+    def route_matrix(locations):
+        calls.append(list(locations))
+        dist = [[abs(POSITION_KM[a] - POSITION_KM[b]) * 1000 for b in locations] for a in locations]
+        return dist, [[d / 10 for d in row] for row in dist]
+
+    monkeypatch.setattr(new, "GOOGLE_MAPS_API_KEY", "test-key")
+    monkeypatch.setattr(new, "resolve_locations", list)
+    monkeypatch.setattr(new, "call_google_route_matrix", route_matrix)
+    with new._CACHE_DB_LOCK, new._CACHE_DB:
+        new._CACHE_DB.execute("DELETE FROM stop_matrix")
+        new._CACHE_DB.execute("DELETE FROM matrix_request")
+    return calls
+
+
+@pytest.fixture
+def client(matrix_calls):
+    return new.app.test_client()
+
+
+def build(client, addresses):
+    r = client.post("/matrix", json={"addresses_text": "\n".join(addresses)})
+    assert r.status_code == 200
+    return r.get_json()
+
+
+def matrix_ts():
+    with new._CACHE_DB_LOCK:
+        return new._CACHE_DB.execute("SELECT ts FROM stop_matrix").fetchone()[0]
+
+
+def test_reoptimize_defaults_to_submitted_order(client):
+    data = build(client, SUBMITTED)
+    assert data["addresses"] == SUBMITTED and data["cached"] is False
+    r = client.post("/reoptimize", json={"matrix_key": data["matrix_key"]})
+    assert r.status_code == 200
+    result = r.get_json()
+    assert result["original"]["order"] == SUBMITTED
+    assert result["original"]["distance_m"] == 6000
+    assert result["optimized"]["order"] == ["A St", "B St", "C St", "D St", "E St"]
+    assert result["optimized"]["distance_m"] == 4000
+
+
+def test_reoptimize_reversed_and_case_changed_order(client):
+    key = build(client, SUBMITTED)["matrix_key"]
+    r = client.post("/reoptimize", json={"matrix_key": key, "order": [a.upper() for a in reversed(SUBMITTED)]})
+    assert r.status_code == 200
+    result = r.get_json()
+    # Addresses come back as submitted to /matrix; the endpoints of the new order stay fixed
+    assert result["original"]["order"] == list(reversed(SUBMITTED))
+    assert result["optimized"]["order"] == ["E St", "D St", "C St", "B St", "A St"]
+
+
+def test_same_stops_in_another_order_reuse_the_matrix(client, matrix_calls):
+    first = build(client, SUBMITTED)
+    reordered = ["E St", "B St", "D St", "C St", "A St"]
+    second = build(client, reordered)
+    assert len(matrix_calls) == 1
+    assert second["cached"] is True
+    assert second["matrix_key"] != first["matrix_key"]
+    assert second["addresses"] == reordered
+    result = client.post("/reoptimize", json={"matrix_key": second["matrix_key"]}).get_json()
+    assert result["original"]["order"] == reordered
+    assert result["original"]["distance_m"] == 8000
+    assert result["optimized"]["order"] == ["E St", "D St", "C St", "B St", "A St"]
+
+
+def test_cache_hit_restarts_matrix_ttl(client):
+    build(client, SUBMITTED)
+    stale = matrix_ts() - new.MATRIX_CACHE_TTL + 1
+    with new._CACHE_DB_LOCK, new._CACHE_DB:
+        new._CACHE_DB.execute("UPDATE stop_matrix SET ts = ?", (stale,))
+    assert build(client, SUBMITTED)["cached"] is True
+    assert matrix_ts() - stale > new.MATRIX_CACHE_TTL - 10
+
+
+@pytest.mark.parametrize("order", [
+    ["A St", "C St", "C St", "D St", "E St"],
+    ["A St", "C St", "B St", "E St"],
+    ["A St", "C St", "B St", "D St", "F St"],
+])
+def test_reoptimize_rejects_duplicate_or_missing_stops(client, order):
+    key = build(client, SUBMITTED)["matrix_key"]
+    r = client.post("/reoptimize", json={"matrix_key": key, "order": order})
+    assert r.status_code == 400
+    assert r.get_json()["error"] == "order must list each matrix address exactly once."
+
+
+def test_reoptimize_unknown_key(client):
+    r = client.post("/reoptimize", json={"matrix_key": "nope"})
+    assert r.status_code == 404
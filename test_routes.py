@@ -0,0 +1,92 @@
+# test_routes.py
+import os
+
+import orjson
+import pytest
+import requests
+
+os.environ.setdefault("GEOCODE_CACHE_PATH", ":memory:")
+
+import new
+
+ADDRESSES = ["A St", "B St", "C St", "D St", "E St"]
+
+
+def fake_response(body, status=200):
+    r = requests.Response()
+    r.status_code = status
+    r._content = orjson.dumps(body)
+    r.url = new.GOOGLE_ROUTES_URL
+    return r
+
+
+@pytest.fixture
+def client(monkeypatch):
+    monkeypatch.setattr(new, "GOOGLE_MAPS_API_KEY", "test-key")
+    # Send the user's strings straight to the Routes API stub instead of geocoding them
+    monkeypatch.setattr(new, "resolve_locations", list)
+    new._DIRECTIONS_CACHE.clear()
+    return new.app.test_client()
+
+
+def stub_routes(monkeypatch, original, optimized, status=200):
+    """Stub SESSION.post with one response body for the plain call and one for the optimized call."""
+    sent = []
+
+    def post(url, data=None, headers=None, **kwargs):
+        body = orjson.loads(data)
+        sent.append(body)
+        return fake_response(optimized if body["optimizeWaypointOrder"] else original, status)
+
+    monkeypatch.setattr(new.SESSION, "post", post)
+    return sent
+
+
+def optimize(client):
+    return client.post("/optimize", json={"addresses_text": "\n".join(ADDRESSES)})
+
+
+def test_missing_distance_and_string_durations(client, monkeypatch):
+    # proto3 JSON drops zero-valued fields, so a zero-length route has no distanceMeters at all
+    stub_routes(monkeypatch, {"routes": [{"duration": "123s"}]},
+                {"routes": [{"distanceMeters": 900, "duration": "100.5s",
+                             "optimizedIntermediateWaypointIndex": [0, 1, 2]}]})
+    r = optimize(client)
+    assert r.status_code == 200
+    data = r.get_json()
+    assert data["original"]["distance_m"] == 0
+    assert data["original"]["duration_s"] == 123
+    assert data["optimized"]["distance_m"] == 900
+    assert data["optimized"]["duration_s"] == 100
+
+
+def test_optimized_index_maps_back_to_user_addresses(client, monkeypatch):
+    sent = stub_routes(monkeypatch, {"routes": [{"distanceMeters": 5000, "duration": "600s"}]},
+                       {"routes": [{"distanceMeters": 4000, "duration": "500s",
+                                    "optimizedIntermediateWaypointIndex": [2, 0, 1]}]})
+    data = optimize(client).get_json()
+    assert data["original"]["order"] == ADDRESSES
+    assert data["optimized"]["order"] == ["A St", "D St", "B St", "C St", "E St"]
+    assert data["optimized"]["waypoint_order_indices"] == [2, 0, 1]
+    assert data["savings"]["distance_m_saved"] == 1000
+    assert sorted(b["optimizeWaypointOrder"] for b in sent) == [False, True]
+    assert all(b["intermediates"] == [{"address": a} for a in ADDRESSES[1:-1]] for b in sent)
+
+
+def test_empty_body_is_zero_results(client, monkeypatch):
+    stub_routes(monkeypatch, {}, {})
+    r = optimize(client)
+    assert r.status_code == 502
+    data = r.get_json()
+    assert data["error"] == "Routes API (non-optimized) error: ZERO_RESULTS"
+    assert not new._DIRECTIONS_CACHE
+
+
+def test_http_error_uses_google_error_response(client, monkeypatch):
+    error = {"error": {"code": 403, "status": "PERMISSION_DENIED", "message": "API key not valid."}}
+    stub_routes(monkeypatch, error, error, status=403)
+    r = optimize(client)
+    assert r.status_code == 403
+    data = r.get_json()
+    assert data["error"] == "Google Routes API HTTP error"
+    assert data["details"] == error
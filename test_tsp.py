@@ -0,0 +1,33 @@
+# test_tsp.py
+import itertools
+import os
+import random
+
+os.environ.setdefault("GEOCODE_CACHE_PATH", ":memory:")
+
+import new
+
+
+def brute_force_length(dist):
+    n = len(dist)
+    return min(new.path_length(dist, [0, *p, n - 1]) for p in itertools.permutations(range(1, n - 1)))
+
+
+def test_held_karp_matches_brute_force():
+    rng = random.Random(1)
+    for n in range(2, new.MAX_STOPS + 1):
+        coords = [(rng.uniform(40, 41), rng.uniform(-74, -73)) for _ in range(n)]
+        dist = new.haversine_matrix(coords)
+        order = new.held_karp(dist)
+        assert order[0] == 0 and order[-1] == n - 1
+        assert sorted(order) == list(range(n))
+        assert abs(new.path_length(dist, order) - brute_force_length(dist)) < 1e-6
+
+
+def test_held_karp_asymmetric_matrix():
+    rng = random.Random(2)
+    n = 7
+    dist = [[0 if i == j else rng.randint(1, 100) for j in range(n)] for i in range(n)]
+    order = new.held_karp(dist)
+    assert sorted(order) == list(range(n))
+    assert new.path_length(dist, order) == brute_force_length(dist)
@@ -0,0 +1,10 @@
+# wsgi.py
+# Production entry point, e.g.:
+#   gunicorn -k gevent -w 4 --worker-connections 1000 -b 0.0.0.0:5000 wsgi:application
+#   (--worker-connections should match WORKER_CONNECTIONS, which sizes new.EXECUTOR under gevent)
+# Patch before the app imports requests so outbound Google calls yield instead of blocking.
+# SQLite cache reads/writes are not patched: each one briefly blocks this worker's other connections.
+from gevent import monkey
+monkey.patch_all()
+
+from new import app as application  # noqa: E402